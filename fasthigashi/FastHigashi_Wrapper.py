@@ -13,11 +13,13 @@ try:
 	from .parafac2_intergrative import Fast_Higashi_core
 	from .preprocessing import calc_bulk, filter_bin, normalize_per_cell, normalize_by_coverage, Clip, normalize_per_batch
 	from .sparse_for_schic import Sparse, Chrom_Dataset
+	from .Fast_process import load_sparse_adj, query_free_memory
 except:
 	try:
 		from parafac2_intergrative import Fast_Higashi_core
 		from preprocessing import calc_bulk, filter_bin, normalize_per_cell, normalize_by_coverage, Clip, normalize_per_batch
 		from sparse_for_schic import Sparse, Chrom_Dataset
+		from Fast_process import load_sparse_adj, query_free_memory
 	except:
 		raise EOFError
 
@@ -59,41 +61,26 @@ def get_free_gpu(num=1):
     
     if visible_devices is None:
         print("No GPUs allocated. Running on CPU.")
+        import psutil
         mem = psutil.virtual_memory().available
         return None, None, mem  # Return CPU memory
 
     # Map visible devices to physical device IDs
     visible_devices = [int(x) for x in visible_devices.split(',')]
 
-    # Query memory for allocated GPUs
-    memory_all = []
-    memory_used = []
-    for gpu_id in visible_devices:
-        try:
-            props = torch.cuda.get_device_properties(gpu_id)
-            total_mem = props.total_memory  # Total GPU memory
-            reserved_mem = torch.cuda.memory_reserved(gpu_id)  # Reserved memory
-            used_mem = torch.cuda.memory_allocated(gpu_id)  # Used memory
-            available_mem = total_mem - reserved_mem  # Free memory
-            memory_all.append(total_mem)
-            memory_used.append(used_mem)
-        except Exception as e:
-            print(f"Error querying GPU {gpu_id}: {e}")
-            memory_all.append(0)
-            memory_used.append(0)
-
-    # Calculate available memory
-    memory_available = [m1 - m2 for m1, m2 in zip(memory_all, memory_used)]
+    # Query free memory for allocated GPUs, indexed like the torch devices
+    memory_available = query_free_memory(visible_devices)
     if len(memory_available) > 0:
-        max_mem = np.max(memory_available)
-        ids = np.where(np.array(memory_available) >= max_mem - 1000)[0]
-        chosen_id = int(np.random.choice(ids, 1)[0])
+        chosen_id = int(np.argmax(memory_available))
+        max_mem = memory_available[chosen_id]
         global_gpu_id = visible_devices[chosen_id]  # Map back to global GPU ID
         print(f"Setting to GPU:{global_gpu_id}, available memory = {max_mem} bytes")
-        torch.cuda.set_device(global_gpu_id)
-        return torch.device(f"cuda:{global_gpu_id}"), global_gpu_id, max_mem
+        # torch only sees the visible devices, numbered from 0
+        torch.cuda.set_device(chosen_id)
+        return torch.device(f"cuda:{chosen_id}"), global_gpu_id, max_mem
     else:
         print("No free GPUs found. Running on CPU.")
+        import psutil
         mem = psutil.virtual_memory().available
         return None, None, mem
 
@@ -247,13 +234,13 @@ class FastHigashi():
 			fac_size=None,
 			merge_fac_row=1, merge_fac_col=1,
 			is_sym=True,
-			filename_pattern='%s_sparse_adj.npy',
+			filename_pattern='%s_sparse_adj.h5',
 			force_shift=None,
 	        batch_norm=True,
 			bar=None):
 
 		filename = filename_pattern % chrom
-		a = np.load(os.path.join(raw_dir, filename), allow_pickle=True)[reorder]
+		a = load_sparse_adj(os.path.join(raw_dir, filename), reorder)
 		# For data with blacklist, block those regions
 		try:
 			blacklist = np.load(os.path.join(self.temp_dir, "raw", "blacklist.npy"), allow_pickle=True).item()
@@ -457,7 +444,7 @@ class FastHigashi():
 		read_count_all = 0
 		for chrom in chrom_list:
 			read_count = []
-			a = np.load(os.path.join(raw_dir, "%s_sparse_adj.npy" % chrom), allow_pickle=True)
+			a = load_sparse_adj(os.path.join(raw_dir, "%s_sparse_adj.h5" % chrom))
 			bulk = self.sum_sparse(a)
 			cov = np.sum(bulk > 0, axis=-1)
 			n_bin = np.sum(cov > 0.1 * cov.shape[0] * scale)
@@ -511,7 +498,7 @@ class FastHigashi():
 				off_diag=self.off_diag,
 				fac_size=1,
 				merge_fac_row=int(res / self.config['resolution']), merge_fac_col=int(res / self.config['resolution']),
-				filename_pattern='%s_sparse_adj.npy',
+				filename_pattern='%s_sparse_adj.h5',
 				force_shift=False,
 			)
 
@@ -915,7 +902,8 @@ if __name__ == '__main__':
 				 do_rwr=args.do_rwr,
 				 do_col=args.do_col,
 				 no_col=args.no_col)
-	if not os.path.exists(os.path.join(wrapper.temp_dir, "raw", "%s_sparse_adj.npy" % wrapper.chrom_list[0])):
+	sparse_adj_path = os.path.join(wrapper.temp_dir, "raw", "%s_sparse_adj" % wrapper.chrom_list[0])
+	if not (os.path.exists(sparse_adj_path + ".h5") or os.path.exists(sparse_adj_path + ".npy")):
 		start = time.time()
 		wrapper.fast_process_data()
 		print("contact pairs to sparse mtx takes: %.2f s" % (time.time() - start))
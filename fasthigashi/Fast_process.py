@@ -1,13 +1,15 @@
 import argparse
 import shutil
-import os
+import os, sys, zlib, itertools
+import multiprocessing
+from multiprocessing import shared_memory
 import numpy as np
 import torch
 import torch.nn.functional as F
 from tqdm.auto import tqdm, trange
 from scipy.sparse import csr_matrix, vstack, SparseEfficiencyWarning, diags, \
 	hstack
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import h5py, math
 import pandas as pd
 
@@ -35,6 +37,42 @@ def parse_args():
 	return parser.parse_args()
 
 
+def nvml_handle(pynvml, gpu_id):
+    # NVML enumerates the devices in PCI bus order while torch numbers the visible devices from 0 following
+    # CUDA_DEVICE_ORDER (FASTEST_FIRST by default), so the torch device is looked up by UUID, or by PCI bus id
+    # on torch builds that don't report the UUID
+    props = torch.cuda.get_device_properties(gpu_id)
+    try:
+        return pynvml.nvmlDeviceGetHandleByUUID("GPU-%s" % props.uuid)
+    except Exception:
+        return pynvml.nvmlDeviceGetHandleByPciBusId(
+            "%08x:%02x:%02x.0" % (props.pci_domain_id, props.pci_bus_id, props.pci_device_id))
+
+
+def query_free_memory(visible_devices):
+    # NVML reports the free memory of the devices without creating a CUDA context on each of them
+    try:
+        import pynvml
+        pynvml.nvmlInit()
+        try:
+            return [pynvml.nvmlDeviceGetMemoryInfo(nvml_handle(pynvml, i)).free for i in range(len(visible_devices))]
+        finally:
+            pynvml.nvmlShutdown()
+    except ImportError:
+        print("pynvml is not installed, estimating GPU memory through torch")
+    except Exception as e:
+        print(f"Error querying GPUs through NVML: {e}")
+    # torch numbers the visible devices from 0, total - reserved doesn't need a CUDA context either
+    free_memory = []
+    for i in range(len(visible_devices)):
+        try:
+            free_memory.append(torch.cuda.get_device_properties(i).total_memory - torch.cuda.memory_reserved(i))
+        except Exception as e:
+            print(f"Error querying GPU {visible_devices[i]}: {e}")
+            free_memory.append(0)
+    return free_memory
+
+
 def get_free_gpu():
     # Get the list of allocated GPUs from CUDA_VISIBLE_DEVICES
     visible_devices = os.environ.get('CUDA_VISIBLE_DEVICES', None)
@@ -46,25 +84,16 @@ def get_free_gpu():
     # Map visible devices to physical device IDs
     visible_devices = [int(x) for x in visible_devices.split(',')]
 
-    # Query free memory for allocated GPUs
-    free_memory = []
-    for gpu_id in visible_devices:
-        try:
-            # Calculate available memory for each GPU
-            memory_free = torch.cuda.get_device_properties(gpu_id).total_memory - torch.cuda.memory_reserved(gpu_id)
-            free_memory.append(memory_free)
-        except Exception as e:
-            print(f"Error querying GPU {gpu_id}: {e}")
-            free_memory.append(0)
+    # Query free memory for allocated GPUs, indexed like the torch devices
+    free_memory = query_free_memory(visible_devices)
 
     if len(free_memory) > 0:
         # Select GPU with the maximum available memory
-        max_mem = np.max(free_memory)
-        ids = np.where(np.array(free_memory) == max_mem)[0]
-        chosen_id = int(np.random.choice(ids, 1)[0])
+        chosen_id = int(np.argmax(free_memory))
         global_gpu_id = visible_devices[chosen_id]  # Map back to global GPU ID
         print(f"Setting to GPU:{global_gpu_id}")
-        torch.cuda.set_device(global_gpu_id)
+        # torch only sees the visible devices, numbered from 0
+        torch.cuda.set_device(chosen_id)
     else:
         print("No free GPU found. Using CPU.")
         return None
@@ -100,69 +129,341 @@ def generate_chrom_start_end(config):
 	chrom_size = pd.read_table(genome_reference_path, sep="\t", header=None)
 	chrom_size.columns = ['chrom', 'size']
 	# build a list that stores the start and end of each chromosome (unit of the number of bins)
-	chrom_start_end = np.zeros((len(chrom_list), 2), dtype='int')
-	for i, chrom in enumerate(chrom_list):
-		size = chrom_size[chrom_size['chrom'] == chrom]
-		size = size['size'][size.index[0]]
-		n_bin = int(math.ceil(size / res))
-		chrom_start_end[i, 1] = chrom_start_end[i, 0] + n_bin
-		if i + 1 < len(chrom_list):
-			chrom_start_end[i + 1, 0] = chrom_start_end[i, 1]
+	sizes = chrom_size.drop_duplicates('chrom').set_index('chrom').loc[chrom_list, 'size'].to_numpy()
+	n_bins = np.ceil(sizes / res).astype('int')
+	ends = np.cumsum(n_bins)
+	chrom_start_end = np.stack([ends - n_bins, ends], axis=1)
 	
 	# print("chrom_start_end", chrom_start_end)
 	np.save(os.path.join(temp_dir, "chrom_start_end.npy"), chrom_start_end)
 
 
-def data2mtx(config, file, chrom_start_end, verbose, cell_id, blacklist=""):
-	if type(file) is str:
-		if "header_included" in config:
-			if config['header_included']:
-				tab = pd.read_table(file, sep="\t")
-			else:
-				tab = pd.read_table(file, sep="\t", header=None)
-				tab.columns = config['contact_header'][:len(tab.columns)]
+def get_pool(max_workers):
+	# fork lets the workers share the parent's memory copy-on-write instead of re-importing everything
+	if sys.platform.startswith('linux'):
+		return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('fork'))
+	return ProcessPoolExecutor(max_workers=max_workers)
+
+
+# Columns of data.txt that are needed to build the contact maps, and the types they are parsed into
+data_txt_types = {'cell_id': 'int32', 'chrom1': 'category', 'pos1': 'int32', 'chrom2': 'category', 'pos2': 'int32',
+                  'count': 'float32'}
+
+
+def get_data_txt_options(path):
+	with open(path, 'r') as f:
+		header = f.readline().rstrip('\n').split('\t')
+	columns = [c for c in data_txt_types if c in header]
+	return columns, {c: data_txt_types[c] for c in columns}
+
+
+def get_arrow_csv_options(columns, dtypes):
+	import pyarrow as pa
+	import pyarrow.csv as pacsv
+	column_types = {c: pa.dictionary(pa.int32(), pa.string()) if t == 'category' else pa.from_numpy_dtype(np.dtype(t))
+	                for c, t in dtypes.items()}
+	return dict(
+		read_options=pacsv.ReadOptions(block_size=64 << 20, use_threads=True),
+		parse_options=pacsv.ParseOptions(delimiter="\t"),
+		convert_options=pacsv.ConvertOptions(column_types=column_types, include_columns=columns))
+
+
+# Read the whole data.txt, with the multithreaded pyarrow reader when it is installed
+def read_data_txt(path):
+	columns, dtypes = get_data_txt_options(path)
+	try:
+		import pyarrow.csv as pacsv
+	except ImportError:
+		return pd.read_table(path, sep="\t", usecols=columns, dtype=dtypes)
+	return pacsv.read_csv(path, **get_arrow_csv_options(columns, dtypes)).to_pandas()
+
+
+# Stream data.txt from a binary file handle as consecutive DataFrames
+def iter_data_txt(path, csv_file, chunksize):
+	columns, dtypes = get_data_txt_options(path)
+	try:
+		import pyarrow.csv as pacsv
+	except ImportError:
+		yield from pd.read_csv(csv_file, chunksize=chunksize, sep="\t", usecols=columns, dtype=dtypes)
+		return
+	for batch in pacsv.open_csv(csv_file, **get_arrow_csv_options(columns, dtypes)):
+		yield batch.to_pandas()
+
+
+# Encode chromosome names as their index in chrom_list, -1 for the ones that are not used
+# The codes of a categorical are int8 for up to 127 chromosomes, and a categorical input is only recoded,
+# so no string is compared per contact
+def encode_chrom(chrom, chrom_list):
+	return np.asarray(pd.Categorical(chrom, categories=chrom_list).codes)
+
+
+# Pull out the columns data2mtx needs as plain numeric numpy arrays, so that no DataFrame is sent to the workers
+# and the arrays can be put in shared memory
+def table2arrays(tab, chrom_list):
+	count = tab['count'].to_numpy(dtype='float32') if 'count' in tab.columns else np.ones(len(tab), dtype='float32')
+	chrom1 = encode_chrom(tab['chrom1'], chrom_list)
+	chrom2 = encode_chrom(tab['chrom2'], chrom_list)
+	return chrom1, tab['pos1'].to_numpy(dtype='int32'), chrom2, tab['pos2'].to_numpy(dtype='int32'), count
+
+
+# Copy arrays into shared memory blocks, the workers attach to them by name through the returned specs
+def share_arrays(arrays):
+	shms, specs = [], []
+	for a in arrays:
+		shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+		np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[:] = a
+		shms.append(shm)
+		specs.append((shm.name, a.shape, a.dtype.str))
+	return shms, specs
+
+
+# Process a batch of cells, the contacts of cell_ids[i] are rows bounds[i]:bounds[i + 1] of the arrays
+def data2mtx_batch(config, arrays, bounds, cell_ids, chrom_start_end, blacklist=None):
+	result = []
+	for i, cell_id in enumerate(cell_ids):
+		rows = slice(bounds[i], bounds[i + 1])
+		result.append(data2mtx(config, *[a[rows] for a in arrays], chrom_start_end, False, cell_id, blacklist))
+	return result
+
+
+def shared_data2mtx_batch(config, specs, bounds, cell_ids, chrom_start_end, blacklist=None):
+	shms = [shared_memory.SharedMemory(name=name) for name, _, _ in specs]
+	arrays = [np.ndarray(shape, dtype=dtype, buffer=shm.buf) for shm, (_, shape, dtype) in zip(shms, specs)]
+	result = data2mtx_batch(config, arrays, bounds, cell_ids, chrom_start_end, blacklist)
+	# views on the buffers have to be gone before closing
+	del arrays
+	for shm in shms:
+		shm.close()
+	return result
+
+
+# A few tasks per worker for load balancing, but enough cells per task to amortize the scheduling
+def get_cells_per_task(cell_num, cpu_num):
+	return int(min(128, max(1, math.ceil(cell_num / (cpu_num * 4)))))
+
+
+# Submit the cells of a table (cells don't need to be sorted) as batched data2mtx tasks
+def submit_table(pool, config, tab, chrom_start_end, blacklist, cells_per_task=64):
+	cell_ids = tab['cell_id'].to_numpy()
+	order = np.argsort(cell_ids, kind='stable')
+	arrays = [a[order] for a in table2arrays(tab, config['chrom_list'])]
+	cell_ids, starts = np.unique(cell_ids[order], return_index=True)
+	bounds = np.append(starts, len(order))
+	p_list = []
+	for b in range(0, len(cell_ids), cells_per_task):
+		lo, hi = bounds[b], bounds[min(b + cells_per_task, len(cell_ids))]
+		p_list.append(pool.submit(data2mtx_batch, config, [a[lo:hi] for a in arrays],
+		                          bounds[b:b + cells_per_task + 1] - lo, cell_ids[b:b + cells_per_task],
+		                          chrom_start_end, blacklist))
+	return p_list, int(cell_ids[-1] + 1) if len(cell_ids) > 0 else 0
+
+
+# Build the contact maps of every cell of an in-memory data.txt table,
+# the contacts are put in shared memory once and the workers get batches of cells
+def table2mtx_all(config, data, chrom_start_end, blacklist, cpu_num):
+	chrom_list = config['chrom_list']
+	# group the contacts of each cell into one contiguous block, cell i is rows bounds[i]:bounds[i+1]
+	data = data.sort_values('cell_id', kind='stable')
+	cell_num = int(data['cell_id'].max() + 1)
+	bounds = np.searchsorted(data['cell_id'].values, np.arange(cell_num + 1))
+	shms, specs = share_arrays(table2arrays(data, chrom_list))
+	del data
+	cells_per_task = get_cells_per_task(cell_num, cpu_num)
+	bar = trange(cell_num, mininterval=0.5)
+	mtx_all_list = [[0] * cell_num for i in range(len(chrom_list))]
+	try:
+		# the pool is shut down on leaving the with block, before the shared memory goes away
+		with get_pool(cpu_num) as pool:
+			p_list = []
+			for b in range(0, cell_num, cells_per_task):
+				cell_ids = np.arange(b, min(b + cells_per_task, cell_num))
+				p_list.append(pool.submit(shared_data2mtx_batch, config, specs, bounds[b:b + len(cell_ids) + 1],
+				                          cell_ids, chrom_start_end, blacklist))
+
+			for p in as_completed(p_list):
+				result = p.result()
+				for mtx_list, cell_id in result:
+					for i in range(len(chrom_list)):
+						mtx_all_list[i][cell_id] = mtx_list[i]
+				# one update per batch of cells
+				bar.update(len(result))
+		bar.close()
+	finally:
+		for shm in shms:
+			shm.close()
+			shm.unlink()
+	return mtx_all_list
+
+
+def file2mtx(config, file, chrom_start_end, verbose, cell_id, blacklist=None):
+	if "header_included" in config:
+		if config['header_included']:
+			tab = pd.read_table(file, sep="\t")
 		else:
 			tab = pd.read_table(file, sep="\t", header=None)
-			tab.columns = config['contact_header']
-		if 'count' not in tab.columns:
-			tab['count'] = 1
+			tab.columns = config['contact_header'][:len(tab.columns)]
 	else:
-		tab = file
-	
-	data = tab
+		tab = pd.read_table(file, sep="\t", header=None)
+		tab.columns = config['contact_header']
+	return data2mtx(config, *table2arrays(tab, config['chrom_list']), chrom_start_end, verbose, cell_id, blacklist)
+
+
+# chrom1 / chrom2 are chromosome indices in chrom_list (see encode_chrom)
+def data2mtx(config, chrom1, pos1, chrom2, pos2, count, chrom_start_end, verbose, cell_id, blacklist=None):
 	# fetch info from config
 	res = config['resolution']
-	chrom_list = config['chrom_list']
-	
-	data = data[(data['chrom1'] == data['chrom2']) & ((np.abs(data['pos2'] - data['pos1']) >= 2500) | (np.abs(data['pos2'] - data['pos1']) == 0))]
 
-	if blacklist != "" and len(data) > 0:
-		data = remove_blacklist(blacklist, data)
+	pos1 = np.asarray(pos1, dtype='int32')
+	pos2 = np.asarray(pos2, dtype='int32')
+	count = np.asarray(count, dtype='float32')
+	# keep the intra-chromosomal contacts on chromosomes of chrom_list,
+	# that are either >= 2.5kb apart or on the exact same position
+	d = pos2 - pos1
+	keep = (chrom1 == chrom2) & (chrom1 >= 0) & ((np.abs(d) >= 2500) | (d == 0))
+	del d
+	if blacklist is not None and keep.any():
+		# only cis contacts are left, so both anchors are on chrom1
+		keep &= ~(in_blacklist(blacklist, chrom1, pos1) | in_blacklist(blacklist, chrom1, pos2))
+	chrom1, pos1, pos2, count = chrom1[keep], pos1[keep], pos2[keep], count[keep]
+
+	# bins of a chromosome always fit in int32, which halves the COO triplets compared to the default int64
+	# integer floor division directly gives the int32 bins without a float64 temporary
+	bin1 = pos1 // np.int32(res)
+	bin2 = pos2 // np.int32(res)
+
+	sizes = chrom_start_end[:, 1] - chrom_start_end[:, 0]
+	m1_list = build_csrs(chrom1, bin1, bin2, count, sizes)
+	return m1_list, cell_id
+
+
+# Build the symmetric contact map of every chromosome from the cis contacts of one cell
+def build_csrs(chrom, bin1, bin2, count, sizes):
+	# group the contacts by chromosome with one stable sort and one gather per array,
+	# the contacts of chromosome i are then the views bounds[i]:bounds[i+1], no per chromosome copies
+	order = np.argsort(chrom, kind='stable')
+	bin1, bin2, count = bin1[order], bin2[order], count[order]
+	bounds = np.zeros(len(sizes) + 1, dtype='int64')
+	np.cumsum(np.bincount(chrom, minlength=len(sizes)), out=bounds[1:])
+	del order, chrom
 
-	pos1 = np.array(data['pos1'])
-	pos2 = np.array(data['pos2'])
-	bin1 = np.floor(pos1 / res).astype('int')
-	bin2 = np.floor(pos2 / res).astype('int')
-	
-	chrom1, chrom2 = np.array(data['chrom1'].values), np.array(data['chrom2'].values)
-	count = np.array(data['count'].values)
-	
-	del data
-	
 	m1_list = []
-	for i, chrom in enumerate(chrom_list):
-		mask = (chrom1 == chrom)  # & (bin1 != bin2)
-		size = chrom_start_end[i, 1] - chrom_start_end[i, 0]
-		temp_weight2 = count[mask]
-		m1 = csr_matrix((temp_weight2, (bin1[mask], bin2[mask])), shape=(size, size), dtype='float32')
-		m1 = m1 + m1.T
+	for i, size in enumerate(sizes):
+		rows = slice(bounds[i], bounds[i + 1])
+		# symmetrize by feeding both (bin1, bin2) and (bin2, bin1) to a single COO -> CSR conversion,
+		# duplicates are summed there, which gives the same matrix as m1 + m1.T (diagonal counted twice)
+		b1 = np.concatenate([bin1[rows], bin2[rows]])
+		b2 = np.concatenate([bin2[rows], bin1[rows]])
+		w = np.concatenate([count[rows], count[rows]])
+		m1 = csr_matrix((w, (b1, b2)), shape=(size, size), dtype='float32')
 		m1_list.append(m1)
-		count = count[~mask]
-		bin1 = bin1[~mask]
-		bin2 = bin2[~mask]
-		chrom1 = chrom1[~mask]
-	
-	return m1_list, cell_id
+	return m1_list
+
+
+def deflate_chunk(a):
+	return zlib.compress(a.tobytes(), 1)
+
+
+# Write a stream of 1d arrays into a gzip filtered dataset, bypassing the hdf5 filter pipeline:
+# every full chunk is deflated by the (thread) executor and written as is with write_direct_chunk
+def write_direct_chunks(dset, blocks, executor):
+	chunk = dset.chunks[0]
+	offset = 0
+	rest = np.zeros(0, dtype=dset.dtype)
+	for block in itertools.chain(blocks, [None]):
+		if block is None:
+			if len(rest) == 0:
+				break
+			# the last chunk still has to be a full chunk, pad it with zeros
+			rest = np.concatenate([rest, np.zeros(chunk - len(rest), dtype=dset.dtype)])
+		else:
+			rest = np.concatenate([rest, block.astype(dset.dtype, copy=False)])
+		n_full = len(rest) // chunk
+		for compressed in executor.map(deflate_chunk, [rest[k * chunk:(k + 1) * chunk] for k in range(n_full)]):
+			dset.id.write_direct_chunk((offset,), compressed)
+			offset += chunk
+		rest = rest[n_full * chunk:]
+
+
+# Read the [lo, hi) ranges of a dataset written by write_direct_chunks, the inverse of it: the raw chunks covering
+# the ranges are read with read_direct_chunk and inflated by the (thread) executor, as the hdf5 filter pipeline
+# would otherwise decompress them one at a time
+def read_direct_chunks(dset, ranges, executor):
+	chunk = dset.chunks[0]
+	keys = sorted({k for lo, hi in ranges for k in range(lo // chunk, (hi + chunk - 1) // chunk)})
+	raw = [dset.id.read_direct_chunk((k * chunk,)) for k in keys]
+	# bit 0 of the filter mask is set when the deflate filter was skipped for that chunk
+	chunks = dict(zip(keys, executor.map(
+		lambda r: np.frombuffer(r[1] if r[0] & 1 else zlib.decompress(r[1]), dtype=dset.dtype), raw)))
+	del raw
+	result = []
+	for lo, hi in ranges:
+		out = np.empty(hi - lo, dtype=dset.dtype)
+		for k in range(lo // chunk, (hi + chunk - 1) // chunk):
+			a, b = max(lo, k * chunk), min(hi, (k + 1) * chunk)
+			out[a - lo:b - lo] = chunks[k][a - k * chunk:b - k * chunk]
+		result.append(out)
+	return result
+
+
+def is_int16(a):
+	return len(a) == 0 or (a.min() >= -32768 and a.max() <= 32767 and np.all(a == np.round(a)))
+
+
+# Store the sparse matrices of one chromosome (one per cell) in a hdf5 file
+# All cells are stacked as one CSR matrix of shape (cell_num * size, size), the nnz offset of each cell is in cell_ptr
+def save_sparse_adj(path, mtx_list, batch_size=6400):
+	cell_num = len(mtx_list)
+	n_row = mtx_list[0].shape[0]
+	cell_ptr = np.zeros(cell_num + 1, dtype='int64')
+	cell_ptr[1:] = np.cumsum([m.nnz for m in mtx_list])
+	# raw contact counts are small integers, keep them as int16 on disk whenever that is lossless
+	data_dtype = 'int16' if all(is_int16(m.data) for m in mtx_list) else 'float32'
+	batches = range(0, cell_num, batch_size)
+	streams = {
+		'data': (cell_ptr[-1], data_dtype,
+		         (np.concatenate([m.data for m in mtx_list[b:b + batch_size]]) for b in batches)),
+		'indices': (cell_ptr[-1], 'int32',
+		            (np.concatenate([m.indices for m in mtx_list[b:b + batch_size]]) for b in batches)),
+		'indptr': (cell_num * n_row + 1, 'int64', itertools.chain([np.zeros(1, dtype='int64')], (
+			np.concatenate([m.indptr[1:].astype('int64') + cell_ptr[b + i]
+			                for i, m in enumerate(mtx_list[b:b + batch_size])]) for b in batches))),
+	}
+	with h5py.File(path, 'w', rdcc_nbytes=64 << 20) as f, \
+			ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
+		f.attrs['shape'] = mtx_list[0].shape
+		f.attrs['cell_num'] = cell_num
+		f.create_dataset('cell_ptr', data=cell_ptr)
+		for name, (length, dtype, blocks) in streams.items():
+			# ~1MB chunks, maxshape=None so that the chunks can be larger than a small dataset
+			chunks = ((1 << 20) // np.dtype(dtype).itemsize,)
+			dset = f.create_dataset(name, shape=(length,), maxshape=(None,), dtype=dtype, chunks=chunks,
+			                        compression='gzip', compression_opts=1, shuffle=False)
+			write_direct_chunks(dset, blocks, executor)
+
+
+# Load the sparse matrices of one chromosome, or only those of cell_ids (in that order) when it is given,
+# in which case only the cell_ptr ranges of these cells are read
+def load_sparse_adj(path, cell_ids=None):
+	# temp dirs processed before the hdf5 layout still have the pickled .npy files
+	npy_path = os.path.splitext(path)[0] + '.npy'
+	if not os.path.exists(path) and os.path.exists(npy_path):
+		mtx_list = np.load(npy_path, allow_pickle=True)
+		return mtx_list if cell_ids is None else mtx_list[cell_ids]
+	with h5py.File(path, 'r', rdcc_nbytes=64 << 20) as f, \
+			ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
+		shape = tuple(f.attrs['shape'])
+		cell_ptr = f['cell_ptr'][:]
+		cell_ids = np.arange(int(f.attrs['cell_num'])) if cell_ids is None else np.asarray(cell_ids)
+		n_row = shape[0]
+		data, indices = [read_direct_chunks(f[name], [(cell_ptr[i], cell_ptr[i + 1]) for i in cell_ids], executor)
+		                 for name in ['data', 'indices']]
+		indptr = read_direct_chunks(f['indptr'], [(i * n_row, (i + 1) * n_row + 1) for i in cell_ids], executor)
+	# object array so that it can be indexed like the previous np.load(..., allow_pickle=True) result
+	mtx_list = np.empty(len(cell_ids), dtype=object)
+	for j, i in enumerate(cell_ids):
+		mtx_list[j] = csr_matrix(
+			(data[j].astype('float32', copy=False), indices[j], indptr[j] - cell_ptr[i]), shape=shape)
+	return mtx_list
 
 
 # Extra the data.txt table
@@ -173,16 +474,15 @@ def extract_table(config):
 	temp_dir = config['temp_dir']
 	chrom_list = config['chrom_list']
 	if "blacklist" in config:
-		blacklist = config["blacklist"]
+		blacklist = load_blacklist(config["blacklist"], chrom_list)
 	else:
-		blacklist = ""
+		blacklist = None
 	if 'input_format' in config:
 		input_format = config['input_format']
 	else:
 		input_format = 'higashi_v1'
 	
 	chrom_start_end = np.load(os.path.join(temp_dir, "chrom_start_end.npy"))
-	import multiprocessing
 	cpu_num = multiprocessing.cpu_count()
 	if input_format == 'higashi_v1':
 		print("extracting from data.txt")
@@ -192,15 +492,14 @@ def extract_table(config):
 				cell_tab = []
 
 				p_list = []
-				pool = ProcessPoolExecutor(max_workers=cpu_num)
-				print("First calculating how many lines are there")
-				line_count = sum(1 for i in open(os.path.join(data_dir, "data.txt"), 'rb'))
-				print("There are %d lines" % line_count)
-				bar = trange(line_count, desc=' - Processing ', leave=False, )
+				pool = get_pool(cpu_num)
+				# progress in bytes read, so that data.txt doesn't need an extra pass just to count the lines
+				bar = tqdm(total=os.path.getsize(os.path.join(data_dir, "data.txt")), desc=' - Processing ',
+				           leave=False, unit='B', unit_scale=True, mininterval=0.5)
 				cell_num = 0
-				with open(os.path.join(data_dir, "data.txt"), 'r') as csv_file:
+				with open(os.path.join(data_dir, "data.txt"), 'rb') as csv_file:
 					chunk_count = 0
-					reader = pd.read_csv(csv_file, chunksize=chunksize, sep="\t")
+					reader = iter_data_txt(os.path.join(data_dir, "data.txt"), csv_file, chunksize)
 					for chunk in reader:
 						if len(chunk['cell_id'].unique()) == 1:
 							# Only one cell, keep appending
@@ -211,78 +510,47 @@ def extract_table(config):
 							tails = chunk.iloc[np.array(chunk['cell_id']) != last_cell, :]
 							head = chunk.iloc[np.array(chunk['cell_id']) == last_cell, :]
 							cell_tab.append(tails)
-							cell_tab = pd.concat(cell_tab, axis=0).reset_index()
-							for cell_id in np.unique(cell_tab['cell_id']):
-								p_list.append(
-									pool.submit(data2mtx, config, cell_tab[cell_tab['cell_id'] == cell_id].reset_index(),
-									            chrom_start_end, False, cell_id, blacklist))
-								cell_num = max(cell_num, cell_id + 1)
+							cell_tab = pd.concat(cell_tab, axis=0)
+							new_p_list, new_cell_num = submit_table(pool, config, cell_tab, chrom_start_end, blacklist)
+							p_list += new_p_list
+							cell_num = max(cell_num, new_cell_num)
 
 							cell_tab = [head]
-							bar.update(n=chunksize)
-							bar.refresh()
-
+						# byte offset of the reader, so the bar stays in sync whatever the chunk contains
+						bar.update(n=csv_file.tell() - bar.n)
+				bar.close()
 
 				if len(cell_tab) != 0:
-					cell_tab = pd.concat(cell_tab, axis=0).reset_index()
-					for cell_id in np.unique(cell_tab['cell_id']):
-						p_list.append(
-							pool.submit(data2mtx, config, cell_tab[cell_tab['cell_id'] == cell_id].reset_index(),
-							            chrom_start_end, False, cell_id, blacklist))
-						cell_num = max(cell_num, cell_id + 1)
+					cell_tab = pd.concat(cell_tab, axis=0)
+					new_p_list, new_cell_num = submit_table(pool, config, cell_tab, chrom_start_end, blacklist)
+					p_list += new_p_list
+					cell_num = max(cell_num, new_cell_num)
 				cell_num = int(cell_num)
 				mtx_all_list = [[0] * cell_num for i in range(len(chrom_list))]
 
 
 				for p in as_completed(p_list):
-					mtx_list, cell_id = p.result()
-					for i in range(len(chrom_list)):
-						mtx_all_list[i][cell_id] = mtx_list[i]
+					for mtx_list, cell_id in p.result():
+						for i in range(len(chrom_list)):
+							mtx_all_list[i][cell_id] = mtx_list[i]
+				pool.shutdown(wait=True)
 
 			else:
-				data = pd.read_table(os.path.join(data_dir, "data.txt"), sep="\t")
+				data = read_data_txt(os.path.join(data_dir, "data.txt"))
 				# ['cell_name','cell_id', 'chrom1', 'pos1', 'chrom2', 'pos2', 'count']
-				cell_id_all = np.unique(data['cell_id'])
-				cell_num = int(np.max(cell_id_all) + 1)
-				bar = trange(cell_num)
-				mtx_all_list = [[0] * cell_num for i in range(len(chrom_list))]
-				p_list = []
-				pool = ProcessPoolExecutor(max_workers=cpu_num)
-				for cell_id in range(cell_num):
-					p_list.append(pool.submit(data2mtx, config, data[data['cell_id'] == cell_id].reset_index(),
-											  chrom_start_end, False, cell_id, blacklist))
-
-				for p in as_completed(p_list):
-					mtx_list, cell_id = p.result()
-					for i in range(len(chrom_list)):
-						mtx_all_list[i][cell_id] = mtx_list[i]
-					bar.update(1)
-				bar.close()
-				pool.shutdown(wait=True)
+				mtx_all_list = table2mtx_all(config, data, chrom_start_end, blacklist, cpu_num)
+				del data
 
 		else:
-			data = pd.read_table(os.path.join(data_dir, "data.txt"), sep="\t")
-			cell_id_all = np.unique(data['cell_id'])
-			cell_num = int(np.max(cell_id_all) + 1)
-			bar = trange(cell_num)
-			mtx_all_list = [[0] * cell_num for i in range(len(chrom_list))]
-			p_list = []
-			pool = ProcessPoolExecutor(max_workers=cpu_num)
-			for cell_id in range(cell_num):
-				p_list.append(
-					pool.submit(data2mtx, config, data[data['cell_id'] == cell_id].reset_index(), chrom_start_end,
-					            False, cell_id, blacklist))
-			
-			for p in as_completed(p_list):
-				mtx_list, cell_id = p.result()
-				for i in range(len(chrom_list)):
-					mtx_all_list[i][cell_id] = mtx_list[i]
-				bar.update(1)
-			bar.close()
-			pool.shutdown(wait=True)
+			data = read_data_txt(os.path.join(data_dir, "data.txt"))
+			mtx_all_list = table2mtx_all(config, data, chrom_start_end, blacklist, cpu_num)
+			del data
 		for i in range(len(chrom_list)):
-			np.save(os.path.join(temp_dir, "raw", "%s_sparse_adj.npy" % chrom_list[i]), mtx_all_list[i],
-			        allow_pickle=True)
+			# cell_ids without any contact in data.txt are still placeholders, store them as empty matrices
+			size = chrom_start_end[i, 1] - chrom_start_end[i, 0]
+			mtx_all_list[i] = [csr_matrix((size, size), dtype='float32') if isinstance(m, int) else m
+			                   for m in mtx_all_list[i]]
+			save_sparse_adj(os.path.join(temp_dir, "raw", "%s_sparse_adj.h5" % chrom_list[i]), mtx_all_list[i])
 	elif input_format == 'higashi_v2':
 		print("extracting from filelist.txt")
 		with open(os.path.join(data_dir, "filelist.txt"), "r") as f:
@@ -291,9 +559,9 @@ def extract_table(config):
 		bar = trange(len(filelist))
 		mtx_all_list = [[0] * len(filelist) for i in range(len(chrom_list))]
 		p_list = []
-		pool = ProcessPoolExecutor(max_workers=cpu_num)
+		pool = get_pool(cpu_num)
 		for cell_id, file in enumerate(filelist):
-			p_list.append(pool.submit(data2mtx, config, file, chrom_start_end, False, cell_id, blacklist))
+			p_list.append(pool.submit(file2mtx, config, file, chrom_start_end, False, cell_id, blacklist))
 		
 		for p in as_completed(p_list):
 			mtx_list, cell_id = p.result()
@@ -304,44 +572,44 @@ def extract_table(config):
 		pool.shutdown(wait=True)
 		
 		for i in range(len(chrom_list)):
-			np.save(os.path.join(temp_dir, "raw", "%s_sparse_adj.npy" % chrom_list[i]), mtx_all_list[i],
-			        allow_pickle=True)
+			save_sparse_adj(os.path.join(temp_dir, "raw", "%s_sparse_adj.h5" % chrom_list[i]), mtx_all_list[i])
 	else:
 		print("invalid input format")
 		raise EOFError
 	
 	
-def remove_blacklist(blacklistbed, chromdf):
-	import pybedtools
-	blacklist = pybedtools.BedTool(blacklistbed)
-	left = chromdf[['chrom1', 'pos1', 'pos1']].copy()
-	left.loc[:, 'temp_indexname'] = np.arange(len(left))
-
-	right = chromdf[['chrom2', 'pos2', 'pos2']].copy()
-	right.loc[:, 'temp_indexname'] = np.arange(len(right))
-
-	import tempfile
-	f1 = tempfile.NamedTemporaryFile()
-	left.to_csv(f1, sep="\t", header=False, index=False)
-	bed_anchor = pybedtools.BedTool(f1.name)
-	good_anchor = bed_anchor.subtract(blacklist)
-	good_anchor_left = good_anchor.to_dataframe()
-
-	f2 = tempfile.NamedTemporaryFile()
-	right.to_csv(f2, sep="\t", header=False, index=False)
-	bed_anchor = pybedtools.BedTool(f2.name)
-	good_anchor = bed_anchor.subtract(blacklist)
-	good_anchor_right = good_anchor.to_dataframe()
-
-	good_index = np.intersect1d(good_anchor_left['name'], good_anchor_right['name'])
-	ori_len = len(chromdf)
-	# str1 = "length from %d " % len(chromdf)
-	chromdf =  chromdf.iloc[good_index, :]
-	# str1 += "to %d" % (len(chromdf))
-	# if len(chromdf) < ori_len:
-	# 	print (str1)
-	pybedtools.helpers.cleanup()
-	return chromdf
+# Load a blacklist bed file into {chrom index in chrom_list: (starts, ends)} with starts sorted,
+# ends[i] is the furthest end among the first i + 1 regions so overlapping regions need no merging
+def load_blacklist(blacklistbed, chrom_list):
+	# skip the track / browser lines that UCSC style bed files start with
+	skiprows = 0
+	with open(blacklistbed, 'r') as f:
+		for line in f:
+			if not line.startswith(('track', 'browser')):
+				break
+			skiprows += 1
+	bed = pd.read_table(blacklistbed, sep="\t", header=None, usecols=[0, 1, 2], comment='#', skiprows=skiprows)
+	bed.columns = ['chrom', 'start', 'end']
+	blacklist = {}
+	for chrom, regions in bed.groupby('chrom'):
+		if chrom not in chrom_list:
+			continue
+		regions = regions.sort_values('start')
+		blacklist[chrom_list.index(chrom)] = (regions['start'].values, np.maximum.accumulate(regions['end'].values))
+	return blacklist
+
+
+def in_blacklist(blacklist, chrom, pos):
+	bad = np.zeros(len(pos), dtype=bool)
+	for c in np.unique(chrom):
+		if c not in blacklist:
+			continue
+		starts, ends = blacklist[c]
+		idx = np.where(chrom == c)[0]
+		# the last region starting at or before pos is the only one that can still cover it
+		i = np.searchsorted(starts, pos[idx], side='right') - 1
+		bad[idx] = (i >= 0) & (pos[idx] < ends[np.maximum(i, 0)])
+	return bad
 
 
 if __name__ == '__main__':